@@ -2,24 +2,68 @@
 
 __license__ = 'MIT'
 import json
+import re
+from functools import lru_cache
 from urllib.parse import quote as urlquote
 from urllib.parse import urlparse, ParseResult, parse_qs
 import os
+import tempfile
 import glob
+import shutil
+import tarfile
 import subprocess
 import argparse
 import logging
 import hashlib
+import inspect
+import itertools
 import asyncio
 import aiohttp
-import toml
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+# Without shallow fetches libgit2 would download the whole history, git's partial clones are cheaper
+PYGIT2_SHALLOW = pygit2 is not None and 'depth' in inspect.signature(pygit2.Remote.fetch).parameters
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
 
 CRATES_IO = 'https://static.crates.io/crates'
 CARGO_HOME = 'cargo'
 CARGO_CRATES = f'{CARGO_HOME}/vendor'
 VENDORED_SOURCES = 'vendored-sources'
+# Git dependencies are not checksummed by cargo
+GIT_CARGO_CHECKSUM_URL = 'data:' + urlquote(json.dumps({'package': None, 'files': {}}))
 COMMIT_LEN = 7
+GIT_TARBALL_URLS = {
+    'github.com': 'https://codeload.github.com/{owner}/{repo}/tar.gz/{commit}',
+    'bitbucket.org': 'https://bitbucket.org/{owner}/{repo}/get/{commit}.tar.gz',
+}
+GITLAB_TARBALL_URL = 'https://{host}/{owner}/{repo}/repository/archive.tar.gz?ref={commit}'
+TOML_BARE_KEY = re.compile(r'^[A-Za-z0-9_-]+$')
+SHA256_CACHE = 'sha256.json'
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+MAX_CONCURRENT_SHA256 = 16
 
+_git_packages_tasks = {}
+_git_repo_locks = {}
+_sha256_cache = {}
+_changed_sha256 = set()
+_sha256_tasks = {}
+# Hashes downloaded or revalidated during this run, which need no further checks
+_fresh_sha256 = {}
+
+def get_cache_dir():
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_dir, 'flatpak-cargo')
+
+@lru_cache(maxsize=4096)
 def canonical_url(url):
     'Converts a string to a Cargo Canonical URL, as per https://github.com/rust-lang/cargo/blob/35c55a93200c84a4de4627f1770f76a8ad268a39/src/cargo/util/canonical_url.rs#L19'
     logging.debug('canonicalising %s', url)
@@ -39,80 +83,278 @@ def canonical_url(url):
 
     return u
 
-def get_git_tarball(repo_url, commit):
-    url = canonical_url(repo_url)
+def get_git_tarball(url, commit):
+    'Takes a repo URL already passed through canonical_url(), which has stripped any .git suffix'
+    if url.hostname in GIT_TARBALL_URLS:
+        tarball_url = GIT_TARBALL_URLS[url.hostname]
+    elif url.hostname is not None and url.hostname.split('.')[0] == 'gitlab':
+        tarball_url = GITLAB_TARBALL_URL
+    else:
+        tarball_url = None
     path = url.path.split('/')[1:]
+    if tarball_url is None or len(path) != 2:
+        raise ValueError(f'Don\'t know how to get tarball for {url.geturl()}')
+    owner, repo = path
+    return tarball_url.format(host=url.hostname, owner=owner, repo=repo, commit=commit)
 
-    assert len(path) == 2
-    owner = path[0]
-    if path[1].endswith('.git'):
-        repo = path[1].replace('.git', '')
-    else:
-        repo = path[1]
-    if url.hostname == 'github.com':
-        return f'https://codeload.{url.hostname}/{owner}/{repo}/tar.gz/{commit}'
-    elif url.hostname.split('.')[0] == 'gitlab':
-        return f'https://{url.hostname}/{owner}/{repo}/repository/archive.tar.gz?ref={commit}'
-    elif url.hostname == 'bitbucket.org':
-        return f'https://{url.hostname}/{owner}/{repo}/get/{commit}.tar.gz'
-    else:
-        raise ValueError(f'Don\'t know how to get tarball for {repo_url}')
+def load_sha256_cache():
+    try:
+        with open(os.path.join(get_cache_dir(), SHA256_CACHE), 'r') as f:
+            _sha256_cache.update(json.load(f))
+    except (OSError, ValueError) as e:
+        logging.debug(f'Not using sha256 cache: {e}')
 
-async def get_remote_sha256(url):
-    logging.info(f"started sha256({url})")
-    sha256 = hashlib.sha256()
-    async with aiohttp.ClientSession() as http_session:
+def save_sha256_cache():
+    if not _changed_sha256:
+        return
+    try:
+        cache_dir = get_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = os.path.join(cache_dir, SHA256_CACHE)
+        with open(f'{cache_file}.tmp', 'w') as f:
+            json.dump(_sha256_cache, f)
+        os.replace(f'{cache_file}.tmp', cache_file)
+    except OSError as e:
+        logging.warning(f'Could not save sha256 cache: {e}')
+
+def get_response_validators(response):
+    'Headers that change whenever the remote file does'
+    return [response.headers.get('ETag'), response.headers.get('Last-Modified'),
+            response.headers.get('Content-Length')]
+
+def can_validate(validators):
+    # A file regenerated at the same size keeps its Content-Length, so that alone proves nothing
+    return validators[0] is not None or validators[1] is not None
+
+def remember_sha256(url, sha256, validators):
+    _fresh_sha256[url] = sha256
+    entry = {'sha256': sha256, 'validators': validators}
+    if can_validate(validators) and _sha256_cache.get(url) != entry:
+        _sha256_cache[url] = entry
+        _changed_sha256.add(url)
+
+async def hash_response(response, sha256, sink=None):
+    'Hashes the response body, also writing it to sink if given'
+    def consume(data):
+        sha256.update(data)
+        if sink is not None:
+            sink.write(data)
+
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    # Reads only return what is already buffered, usually a few KiB, so batch them up
+    async for data in response.content.iter_any():
+        buffer += data
+        if len(buffer) >= DOWNLOAD_CHUNK_SIZE:
+            # hashlib releases the GIL on large buffers, so this overlaps other downloads
+            await loop.run_in_executor(None, consume, buffer)
+            buffer = bytearray()
+    consume(buffer)
+
+async def fetch_remote_sha256(url, http_session, sha256_semaphore):
+    async with sha256_semaphore:
+        cached = _sha256_cache.get(url)
+        if cached is not None:
+            async with http_session.head(url, allow_redirects=True) as response:
+                validators = get_response_validators(response) if response.ok else [None] * 3
+            if can_validate(validators) and validators == cached['validators']:
+                logging.debug(f'cached sha256({url})')
+                _fresh_sha256[url] = cached['sha256']
+                return cached['sha256']
+        logging.info(f"started sha256({url})")
+        sha256 = hashlib.sha256()
         async with http_session.get(url) as response:
-            while True:
-                data = await response.content.read(4096)
-                if not data:
-                    break
-                sha256.update(data)
-    logging.info(f"done sha256({url})")
-    return sha256.hexdigest()
+            validators = get_response_validators(response) if response.ok else [None] * 3
+            await hash_response(response, sha256)
+        logging.info(f"done sha256({url})")
+        remember_sha256(url, sha256.hexdigest(), validators)
+        return sha256.hexdigest()
+
+async def get_remote_sha256(url, http_session, sha256_semaphore):
+    if url in _fresh_sha256:
+        return _fresh_sha256[url]
+    # Every crate of a workspace points at the same tarball, so share one download between them
+    if url not in _sha256_tasks:
+        _sha256_tasks[url] = asyncio.ensure_future(
+            fetch_remote_sha256(url, http_session, sha256_semaphore))
+    return await _sha256_tasks[url]
 
 def load_toml(tomlfile='Cargo.lock'):
-    with open(tomlfile, 'r') as f:
-        toml_data = toml.load(f)
+    with open(tomlfile, 'rb') as f:
+        toml_data = tomllib.load(f)
     return toml_data
 
+def get_checksum_index(metadata):
+    'Indexes old style lock file metadata, "checksum <name> <version> (<source>)", by (name, version, source)'
+    checksum_index = {}
+    for key, checksum in metadata.items():
+        kind, _, rest = key.partition(' ')
+        if kind != 'checksum':
+            continue
+        name, version, source = rest.split(' ', 2)
+        checksum_index[(name, version, source[1:-1])] = checksum
+    return checksum_index
+
+def toml_key(key):
+    if TOML_BARE_KEY.match(key):
+        return key
+    return json.dumps(key)
+
+def dump_cargo_config(cargo_vendored_sources):
+    'Formats the vendored sources as a cargo config; the document is a flat table of string tables'
+    lines = []
+    for name, entry in cargo_vendored_sources.items():
+        lines.append(f'[source.{toml_key(name)}]')
+        for key, value in entry.items():
+            lines.append(f'{toml_key(key)} = {json.dumps(value)}')
+        lines.append('')
+    return '\n'.join(lines)
+
+def fetch_git_repo_pygit2(git_url, commit, clone_dir):
+    if os.path.isdir(os.path.join(clone_dir, '.git')):
+        repo = pygit2.Repository(clone_dir)
+    else:
+        repo = pygit2.init_repository(clone_dir)
+        repo.remotes.create('origin', git_url)
+    if repo.head_is_unborn or str(repo.head.target)[:COMMIT_LEN] != commit[:COMMIT_LEN]:
+        if commit not in repo:
+            # Only the tree at the commit is needed, none of the history
+            repo.remotes['origin'].fetch([commit], depth=1)
+        # Only the Cargo.toml files are ever read, so don't check out anything else
+        repo.checkout_tree(repo[commit], strategy=pygit2.GIT_CHECKOUT_FORCE,
+                           paths=['Cargo.toml', '*/Cargo.toml'])
+        repo.set_head(repo[commit].id)
+
 def fetch_git_repo(git_url, commit):
     repo_dir = git_url.replace('://', '_').replace('/', '_')
-    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
-    clone_dir = os.path.join(cache_dir, 'flatpak-cargo', repo_dir)
+    clone_dir = os.path.join(get_cache_dir(), repo_dir)
+    if PYGIT2_SHALLOW:
+        # libgit2 leaves everything but the Cargo.toml files staged as deleted, which git would
+        # refuse to check out over, so the two never share a clone
+        libgit2_dir = f'{clone_dir}.libgit2'
+        try:
+            fetch_git_repo_pygit2(git_url, commit, libgit2_dir)
+            return libgit2_dir
+        except (pygit2.GitError, KeyError) as e:
+            logging.warning(f'libgit2 could not fetch {git_url}, falling back to git: {e}')
     if not os.path.isdir(os.path.join(clone_dir, '.git')):
-        subprocess.run(['git', 'clone', git_url, clone_dir], check=True)
-    rev_parse_proc = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=clone_dir, check=True,
-                                    stdout=subprocess.PIPE)
-    head = rev_parse_proc.stdout.decode().strip()
+        # Only the Cargo.toml files are ever read, so don't fetch or check out anything else
+        subprocess.run(['git', 'clone', '--filter=blob:none', '--no-checkout', git_url, clone_dir],
+                       check=True)
+        subprocess.run(['git', 'config', 'core.sparseCheckout', 'true'], cwd=clone_dir, check=True)
+        info_dir = os.path.join(clone_dir, '.git', 'info')
+        os.makedirs(info_dir, exist_ok=True)
+        with open(os.path.join(info_dir, 'sparse-checkout'), 'w') as f:
+            f.write('Cargo.toml\n')
+        head = ''
+    else:
+        rev_parse_proc = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=clone_dir, check=True,
+                                        stdout=subprocess.PIPE)
+        head = rev_parse_proc.stdout.decode().strip()
     if head[:COMMIT_LEN] != commit[:COMMIT_LEN]:
         subprocess.run(['git', 'fetch', 'origin', commit], cwd=clone_dir, check=True)
         subprocess.run(['git', 'checkout', commit], cwd=clone_dir, check=True)
     return clone_dir
 
-async def get_git_cargo_packages(git_url, commit):
-    logging.info(f'Loading packages from git {git_url}')
-    git_repo_dir = fetch_git_repo(git_url, commit)
-    with open(os.path.join(git_repo_dir, 'Cargo.toml'), 'r') as r:
-        root_toml = toml.loads(r.read())
-    assert 'package' in root_toml or 'workspace' in root_toml
-    packages = {}
-    if 'package' in root_toml:
-        packages[root_toml['package']['name']] = '.'
-    if 'workspace' in root_toml:
-        for member in root_toml['workspace']['members']:
-            for subpkg_toml in glob.glob(os.path.join(git_repo_dir, member, 'Cargo.toml')):
+async def fetch_git_repo_async(git_url, commit):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, fetch_git_repo, git_url, commit)
+
+def extract_cargo_tomls(tarball, dest):
+    tmp_dir = f'{dest}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        with tarfile.open(fileobj=tarball, mode='r|gz') as tar:
+            for member in tar:
+                # Forge archives put everything under a single top-level directory
+                path = member.name.split('/', 1)
+                if not member.isfile() or len(path) != 2 or os.path.basename(path[1]) != 'Cargo.toml':
+                    continue
+                relpath = os.path.normpath(path[1])
+                if os.path.isabs(relpath) or relpath.startswith('..'):
+                    continue
+                target = os.path.join(tmp_dir, relpath)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with tar.extractfile(member) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+        os.replace(tmp_dir, dest)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+async def fetch_cargo_tomls(git_url, commit, tarball_url, http_session, sha256_semaphore):
+    repo_dir = git_url.replace('://', '_').replace('/', '_')
+    tomls_dir = os.path.join(get_cache_dir(), 'tomls', repo_dir, commit)
+    if os.path.isdir(tomls_dir):
+        return tomls_dir
+    logging.info(f'Fetching Cargo.toml files from {tarball_url}')
+    loop = asyncio.get_running_loop()
+    # This is the same archive --git-tarballs points at, so hash it now rather than download it twice
+    sha256 = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=16 * DOWNLOAD_CHUNK_SIZE) as tarball:
+        async with sha256_semaphore, http_session.get(tarball_url) as response:
+            response.raise_for_status()
+            validators = get_response_validators(response)
+            await hash_response(response, sha256, tarball)
+        tarball.seek(0)
+        os.makedirs(os.path.dirname(tomls_dir), exist_ok=True)
+        await loop.run_in_executor(None, extract_cargo_tomls, tarball, tomls_dir)
+    remember_sha256(tarball_url, sha256.hexdigest(), validators)
+    return tomls_dir
+
+async def load_git_cargo_packages(git_url, commit, http_session, sha256_semaphore):
+    if git_url not in _git_repo_locks:
+        _git_repo_locks[git_url] = asyncio.Lock()
+    # All commits of a repo share one clone, so they have to take turns with it
+    async with _git_repo_locks[git_url]:
+        logging.info(f'Loading packages from git {git_url}')
+        # Only the Cargo.toml files are needed, which a forge archive provides without a clone
+        try:
+            tarball_url = get_git_tarball(canonical_url(git_url), commit)
+            git_repo_dir = await fetch_cargo_tomls(git_url, commit, tarball_url, http_session,
+                                                   sha256_semaphore)
+        except ValueError:
+            git_repo_dir = await fetch_git_repo_async(git_url, commit)
+        except (aiohttp.ClientError, asyncio.TimeoutError, tarfile.TarError) as e:
+            # e.g. a sign-in page for a private repo, which git may reach with the user's credentials
+            logging.warning(f'Falling back to git for {git_url}: {e!r}')
+            git_repo_dir = await fetch_git_repo_async(git_url, commit)
+        loop = asyncio.get_running_loop()
+        root_toml = await loop.run_in_executor(None, load_toml,
+                                               os.path.join(git_repo_dir, 'Cargo.toml'))
+        assert 'package' in root_toml or 'workspace' in root_toml
+        packages = {}
+        if 'package' in root_toml:
+            packages[root_toml['package']['name']] = '.'
+        if 'workspace' in root_toml:
+            subpkg_tomls = []
+            for member in root_toml['workspace']['members']:
+                member_toml = os.path.join(git_repo_dir, member, 'Cargo.toml')
+                if glob.has_magic(member):
+                    subpkg_tomls += glob.glob(member_toml)
+                elif os.path.isfile(member_toml):
+                    subpkg_tomls.append(member_toml)
+            pkg_tomls = await asyncio.gather(*[loop.run_in_executor(None, load_toml, subpkg_toml)
+                                               for subpkg_toml in subpkg_tomls])
+            for subpkg_toml, pkg_toml in zip(subpkg_tomls, pkg_tomls):
                 subpkg = os.path.relpath(os.path.dirname(subpkg_toml), git_repo_dir)
-                with open(subpkg_toml, 'r') as s:
-                    pkg_toml = toml.loads(s.read())
                 packages[pkg_toml['package']['name']] = subpkg
-    logging.debug(f'Packages in repo: {packages}')
-    return packages
+        logging.debug(f'Packages in repo: {packages}')
+        return packages
 
-async def get_git_sources(package, tarball=False):
+async def get_git_cargo_packages(git_url, commit, http_session, sha256_semaphore):
+    # Every crate of a workspace asks for the same repo, so share one load between them
+    key = (git_url, commit)
+    if key not in _git_packages_tasks:
+        _git_packages_tasks[key] = asyncio.ensure_future(
+            load_git_cargo_packages(git_url, commit, http_session, sha256_semaphore))
+    return await _git_packages_tasks[key]
+
+async def get_git_sources(package, http_session, sha256_semaphore, tarball=False):
     name = package['name']
     source = package['source']
-    commit = urlparse(source).fragment
+    parsed = urlparse(source)
+    commit = parsed.fragment
     assert commit, 'The commit needs to be indicated in the fragement part'
     canonical = canonical_url(source)
     repo_url = canonical.geturl()
@@ -123,9 +365,10 @@ async def get_git_sources(package, tarball=False):
             'replace-with': VENDORED_SOURCES,
         }
     }
-    rev = parse_qs(urlparse(source).query).get('rev')
-    tag = parse_qs(urlparse(source).query).get('tag')
-    branch = parse_qs(urlparse(source).query).get('branch')
+    query = parse_qs(parsed.query)
+    rev = query.get('rev')
+    tag = query.get('tag')
+    branch = query.get('branch')
     if rev:
         assert len(rev) == 1
         cargo_vendored_entry[repo_url]['rev'] = rev[0]
@@ -136,26 +379,35 @@ async def get_git_sources(package, tarball=False):
         assert len(branch) == 1
         cargo_vendored_entry[repo_url]['branch'] = branch[0]
 
+    # Look up the packages first, that may already have fetched and hashed the tarball
+    git_cargo_packages = await get_git_cargo_packages(repo_url, commit, http_session,
+                                                      sha256_semaphore)
     if tarball:
-        tarball_url = get_git_tarball(source, commit)
-        git_sources = [{
+        tarball_url = get_git_tarball(canonical, commit)
+        fetch_source = {
             'type': 'archive',
             'archive-type': 'tar-gzip',
             'url': tarball_url,
-            'sha256': await get_remote_sha256(tarball_url),
+            'sha256': await get_remote_sha256(tarball_url, http_session, sha256_semaphore),
             'dest': f'{CARGO_CRATES}/{name}',
-        }]
+        }
     else:
-        git_sources = [{
+        fetch_source = {
             'type': 'git',
             'url': repo_url,
             'commit': commit,
             'dest': f'{CARGO_CRATES}/{name}',
-        }]
-    git_cargo_packages = await get_git_cargo_packages(repo_url, commit)
+        }
+    checksum_source = {
+        'type': 'file',
+        'url': GIT_CARGO_CHECKSUM_URL,
+        'dest': f'{CARGO_CRATES}/{name}', #-{version}',
+        'dest-filename': '.cargo-checksum.json',
+    }
     pkg_subpath = git_cargo_packages[name]
     if pkg_subpath != '.':
-        git_sources.append(
+        git_sources = (
+            fetch_source,
             {
                 'type': 'shell',
                 'commands': [
@@ -163,21 +415,16 @@ async def get_git_sources(package, tarball=False):
                     f'mv {CARGO_CRATES}/{name}.repo/{pkg_subpath} {CARGO_CRATES}/{name}',
                     f'rm -rf {CARGO_CRATES}/{name}.repo'
                 ]
-            }
+            },
+            checksum_source,
         )
-    git_sources.append(
-        {
-            'type': 'file',
-            'url': 'data:' + urlquote(json.dumps({'package': None, 'files': {}})),
-            'dest': f'{CARGO_CRATES}/{name}', #-{version}',
-            'dest-filename': '.cargo-checksum.json',
-        }
-    )
+    else:
+        git_sources = (fetch_source, checksum_source)
 
     return (git_sources, cargo_vendored_entry)
 
-async def get_package_sources(package, cargo_lock, git_tarballs=False):
-    metadata = cargo_lock.get('metadata')
+async def get_package_sources(package, checksum_index, http_session, sha256_semaphore,
+                              git_tarballs=False):
     name = package['name']
     version = package['version']
 
@@ -188,17 +435,17 @@ async def get_package_sources(package, cargo_lock, git_tarballs=False):
     source = package['source']
 
     if source.startswith('git+'):
-        return await get_git_sources(package, tarball=git_tarballs)
+        return await get_git_sources(package, http_session, sha256_semaphore, tarball=git_tarballs)
 
-    key = f'checksum {name} {version} ({source})'
-    if metadata is not None and key in metadata:
-        checksum = metadata[key]
+    key = (name, version, source)
+    if key in checksum_index:
+        checksum = checksum_index[key]
     elif 'checksum' in package:
         checksum = package['checksum']
     else:
         logging.warning(f'{name} doesn\'t have checksum')
         return
-    crate_sources = [
+    crate_sources = (
         {
             'type': 'file',
             'url': f'{CRATES_IO}/{name}/{name}-{version}.crate',
@@ -208,45 +455,49 @@ async def get_package_sources(package, cargo_lock, git_tarballs=False):
         },
         {
             'type': 'file',
-            'url': 'data:' + urlquote(json.dumps({'package': checksum, 'files': {}})),
+            # Checksums are hex digests, so they can go in the JSON without escaping
+            'url': 'data:' + urlquote(f'{{"package": "{checksum}", "files": {{}}}}'),
             'dest': f'{CARGO_CRATES}/{name}-{version}',
             'dest-filename': '.cargo-checksum.json',
         },
-    ]
+    )
     return (crate_sources, {'crates-io': {'replace-with': VENDORED_SOURCES}})
 
 async def generate_sources(cargo_lock, git_tarballs=False):
-    sources = []
+    checksum_index = get_checksum_index(cargo_lock.get('metadata', {}))
+    # Bound the downloads being hashed at once, hashing too many at a time just saturates the CPU
+    sha256_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SHA256)
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=16, ttl_dns_cache=300)
+    # We only ever hash the bytes as served, so ask for them unencoded and skip decompression
+    async with aiohttp.ClientSession(connector=connector, auto_decompress=False,
+                                     headers={'Accept-Encoding': 'identity'}) as http_session:
+        pkg_coros = [get_package_sources(p, checksum_index, http_session, sha256_semaphore,
+                                         git_tarballs)
+                     for p in cargo_lock['package']]
+        pkgs = [pkg for pkg in await asyncio.gather(*pkg_coros) if pkg is not None]
+
     cargo_vendored_sources = {
         VENDORED_SOURCES: {'directory': f'{CARGO_CRATES}'},
+        **{k: v for _, cargo_vendored_entry in pkgs for k, v in cargo_vendored_entry.items()},
     }
-    pkg_coros = [get_package_sources(p, cargo_lock, git_tarballs) for p in cargo_lock['package']]
-    for pkg in await asyncio.gather(*pkg_coros):
-        if pkg is None:
-            continue
-        else:
-            pkg_sources, cargo_vendored_entry = pkg
-        sources += pkg_sources
-        cargo_vendored_sources.update(cargo_vendored_entry)
-
-    sources.append({
-        'type': 'shell',
-        'dest': CARGO_CRATES,
-        'commands': [
-            'for c in *.crate; do tar -xf $c; done'
-        ]
-    })
-
     logging.debug(f'Vendored sources: {cargo_vendored_sources}')
-    sources.append({
-        'type': 'file',
-        'url': 'data:' + urlquote(toml.dumps({
-            'source': cargo_vendored_sources,
-        })),
-        'dest': CARGO_HOME,
-        'dest-filename': 'config'
-    })
-    return sources
+
+    return [
+        *itertools.chain.from_iterable(pkg_sources for pkg_sources, _ in pkgs),
+        {
+            'type': 'shell',
+            'dest': CARGO_CRATES,
+            'commands': [
+                'printf \'%s\\0\' *.crate | xargs -0 -P"$(nproc)" -n1 tar -xf'
+            ]
+        },
+        {
+            'type': 'file',
+            'url': 'data:' + urlquote(dump_cargo_config(cargo_vendored_sources)),
+            'dest': CARGO_HOME,
+            'dest-filename': 'config'
+        },
+    ]
 
 def main():
     parser = argparse.ArgumentParser()
@@ -265,10 +516,16 @@ def main():
         loglevel = logging.INFO
     logging.basicConfig(level=loglevel)
 
+    load_sha256_cache()
     generated_sources = asyncio.run(generate_sources(load_toml(args.cargo_lock),
                                     git_tarballs=args.git_tarballs))
-    with open(outfile, 'w') as out:
-        json.dump(generated_sources, out, indent=4, sort_keys=False)
+    # orjson only supports two space indentation, so use that either way to keep output stable
+    with open(outfile, 'wb') as out:
+        if orjson is not None:
+            out.write(orjson.dumps(generated_sources, option=orjson.OPT_INDENT_2))
+        else:
+            out.write(json.dumps(generated_sources, indent=2, ensure_ascii=False).encode())
+    save_sha256_cache()
 
 if __name__ == '__main__':
     main()